@@ -1,14 +1,30 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request
 from flask_cors import CORS
-import requests
-from bs4 import BeautifulSoup
+import asyncio
+import orjson
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import aiohttp
+import ijson
 import os
 from dotenv import load_dotenv
-import re
-from langchain.memory import ConversationBufferMemory
-from langchain.chains import ConversationChain
-from langchain_google_genai import ChatGoogleGenerativeAI
-from serpapi import search
+from hashlib import blake2b
+from urllib.parse import urlsplit
+from cachetools import TTLCache
+from diskcache import Cache
+from simhash import Simhash
+import numpy as np
+import google.generativeai as genai
+try:
+    from .parsing import parse_and_clean
+except ImportError: # run as a script from inside Backend/
+    from parsing import parse_and_clean
+
+# Parse workers (see PARSE_POOL) are spawned processes that re-run this file as __mp_main__.
+# They only need parsing.py, so the process-wide startup below (LLM client, disk cache,
+# event loop thread) is skipped in them.
+IS_PARSE_WORKER = __name__ == "__mp_main__"
 
 # Load environment variables
 load_dotenv()
@@ -19,53 +35,111 @@ CORS(app)
 # Set up API keys
 GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
 SERPAPI_API_KEY = os.getenv("SERPAPI_API_KEY")
+SERPAPI_SEARCH_URL = "https://serpapi.com/search.json"
 
 # API Key Checks
-if not GOOGLE_API_KEY:
+if not GOOGLE_API_KEY and not IS_PARSE_WORKER:
     print("Error: GOOGLE_API_KEY not found in environment variables.")
-if not SERPAPI_API_KEY:
+if not SERPAPI_API_KEY and not IS_PARSE_WORKER:
     print("Error: SERPAPI_API_KEY not found in environment variables.")
 
-# Set up conversation memory
-memory = ConversationBufferMemory()
+# Cache of final answers keyed by normalized query, so repeated questions skip search, scraping and the LLM
+RESPONSE_CACHE = TTLCache(maxsize=1024, ttl=3600)
+response_cache_lock = threading.Lock() # TTLCache is not thread-safe and Flask serves requests on threads
+
+# Disk-backed cache of extracted page text keyed by URL, shared across queries that hit the same pages
+URL_CACHE = None if IS_PARSE_WORKER else Cache('/tmp/deepfetch_urlcache', size_limit=2**30)
+URL_CACHE_TTL = 24 * 60 * 60 # seconds
+
+# Fallback answers returned when the LLM fails; these must never be cached
+LLM_UNAVAILABLE_MESSAGE = "Sorry, the AI assistant is not available right now."
+LLM_ERROR_MESSAGE = "Sorry, I encountered an error while processing your request with the AI model. Please try again."
+
+# Static answering instructions, passed as the model's system instruction. They stay at the very start of
+# every prompt, ahead of the history and the per-query context, so the identical prefix can be served from Gemini's prompt cache.
+STATIC_INSTRUCTION = """You are an AI assistant designed to answer user queries based *only* on the provided web search context.
+Analyze the web search results in the context carefully. Each result starts with "Source URL: [url]".
+Synthesize the information to provide a comprehensive, accurate, and neutral response to the user's query.
+Focus on information directly present in the provided text snippets.
+Do not add information not found in the context. Do not make assumptions or inferences beyond the text.
+If the provided context does not contain sufficient information to answer the query thoroughly, clearly state that the information is limited or not available in the search results.
+Structure the response clearly. Use bullet points or numbered lists if appropriate for readability.
+**Do NOT include inline source citations like [Source: url] within the main body of your answer.**
+Based *only* on the context in the latest message, answer the user query in that message."""
 
 # Initialize LLM
 llm = None
-if GOOGLE_API_KEY:
-    try:
-        llm = ChatGoogleGenerativeAI(
-            model="gemini-1.5-flash",
-            google_api_key=GOOGLE_API_KEY,
-            temperature=0.6, # Slightly lower temp might help follow formatting instructions
-            # Consider adding safety settings if needed
-            # safety_settings={...}
+if not IS_PARSE_WORKER:
+    if GOOGLE_API_KEY:
+        try:
+            genai.configure(api_key=GOOGLE_API_KEY)
+            llm = genai.GenerativeModel(
+                "gemini-1.5-flash",
+                system_instruction=STATIC_INSTRUCTION,
+                generation_config={"temperature": 0.6}, # Slightly lower temp might help follow formatting instructions
+                # Consider adding safety settings if needed
+                # safety_settings={...}
+            )
+            print("Gemini LLM Initialized.")
+        except Exception as e:
+            print(f"Error initializing Gemini LLM: {e}")
+    else:
+        print("Cannot initialize Gemini LLM due to missing GOOGLE_API_KEY.")
+
+# Conversation history in Gemini's content format. Only queries and answers are kept (not the
+# web context) and only for the last few turns, so the history sent per request stays bounded.
+MAX_HISTORY_TURNS = 5
+chat_history = []
+chat_history_lock = threading.Lock()
+
+# Shared event loop for async fetching. It runs in a background thread so the
+# aiohttp session and its connection pool survive across Flask requests.
+event_loop = asyncio.new_event_loop()
+if not IS_PARSE_WORKER:
+    threading.Thread(target=event_loop.run_forever, daemon=True).start()
+http_session = None
+
+async def get_http_session():
+    """
+    Return the shared aiohttp session, creating it on first use.
+    Must be awaited on the shared event loop.
+    """
+    global http_session
+    if http_session is None or http_session.closed:
+        http_session = aiohttp.ClientSession(
+            timeout=aiohttp.ClientTimeout(total=15),
+            # aiodns resolves hostnames concurrently on the loop instead of blocking getaddrinfo calls
+            connector=aiohttp.TCPConnector(resolver=aiohttp.AsyncResolver(), limit=32, ttl_dns_cache=600)
         )
-        print("Gemini LLM Initialized.")
-    except Exception as e:
-        print(f"Error initializing Gemini LLM: {e}")
-else:
-    print("Cannot initialize Gemini LLM due to missing GOOGLE_API_KEY.")
+    return http_session
 
-# Initialize ConversationChain
-conversation = None
-if llm:
-    conversation = ConversationChain(
-        llm=llm,
-        memory=memory,
-        verbose=False # Quieter output unless debugging
-    )
-    print("ConversationChain Initialized.")
-else:
-    print("ConversationChain cannot be initialized because LLM is not available.")
+# Decoding and parsing are CPU-bound; worker processes let pages parse in parallel without holding the GIL.
+# Workers are spawned rather than forked: forking this multithreaded process (event loop thread,
+# Flask request threads) can deadlock the children on locks held at fork time.
+PARSE_POOL = ProcessPoolExecutor(max_workers=os.cpu_count(), mp_context=multiprocessing.get_context("spawn"))
 
+def run_async(coro):
+    """
+    Run a coroutine on the shared event loop and block until it finishes.
+    """
+    return asyncio.run_coroutine_threadsafe(coro, event_loop).result()
 
-def search_and_retrieve(query, num_results=5):
+
+def query_cache_key(query):
+    """
+    Normalize a query and hash it into a compact response-cache key.
+    """
+    return blake2b(query.strip().lower().encode(), digest_size=16).hexdigest()
+
+async def search_and_retrieve(query, num_results=5):
     """
     Uses SerpApi to get search results (organic links).
+    The JSON body is parsed incrementally as it downloads, and each URL is yielded as soon as
+    its result has been read, so extraction starts before the rest of the response arrives.
     """
     if not SERPAPI_API_KEY:
         print("Error: SerpApi API key is missing.")
-        return []
+        return
 
     params = {
         "q": query,
@@ -78,130 +152,231 @@ def search_and_retrieve(query, num_results=5):
 
     try:
         print(f"Performing SerpApi search for: {query}")
-        search_results = search(params)
-
-        urls = []
-        if "organic_results" in search_results:
-            for result in search_results["organic_results"]:
+        session = await get_http_session()
+        async with session.get(SERPAPI_SEARCH_URL, params=params) as response:
+            response.raise_for_status()
+
+            found = 0
+            # organic_results comes after search_metadata, search_parameters and ads in the body;
+            # each read awaits the network, which lets already-dispatched extractions run meanwhile
+            async for result in ijson.items(response.content, "organic_results.item"):
                 if "link" in result:
-                    urls.append(result["link"])
-                if len(urls) >= num_results:
+                    print(f"Found URL: {result['link']}")
+                    yield result["link"]
+                    found += 1
+                if found >= num_results:
                     break
-            print(f"Found URLs: {urls}")
-            return urls
-        else:
-            print("Warning: 'organic_results' not found in SerpApi response.")
-            print(f"SerpApi response keys: {search_results.keys() if isinstance(search_results, dict) else 'Not a dict'}")
-            return []
+
+        if not found:
+            print("Warning: no organic results found in SerpApi response.")
 
     except Exception as e:
         print(f"Error during SerpApi search: {e}")
-        return []
 
-def extract_content(url):
+# Pages whose 64-bit SimHashes differ in at most this many bits are treated as duplicates
+SIMHASH_MAX_DISTANCE = 3
+
+# Passage retrieval: pages are split into overlapping windows, embedded, and only
+# the passages closest to the query are sent to the LLM
+EMBED_MODEL_NAME = "all-MiniLM-L6-v2"
+PASSAGE_SIZE = 500 # characters
+PASSAGE_OVERLAP = 50 # characters
+PASSAGE_MIN_TAIL = 100 # characters; shorter tails are merged into the previous window
+TOP_K_PASSAGES = 8
+embed_model = None
+embed_model_lock = threading.Lock()
+
+async def extract_content(session, url):
     """
     Extract meaningful text content from a web page.
     (Includes robustness improvements from previous step)
     """
+    cached_text = URL_CACHE.get(url)
+    if cached_text is not None:
+        print(f"Using cached content for: {url}")
+        return cached_text
+
+    print(f"Processing content from: {url}")
     try:
         headers = {
-            "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/108.0.0.0 Safari/537.36"
+            "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/108.0.0.0 Safari/537.36",
+            "Accept": "text/html,application/xhtml+xml",
+            "Accept-Encoding": "gzip, br, deflate" # aiohttp decompresses transparently (br needs the Brotli package)
         }
-        response = requests.get(url, headers=headers, timeout=15, stream=True, verify=True)
-        response.raise_for_status()
-
-        content_type = response.headers.get('content-type', '').lower()
-        if 'text/html' not in content_type:
-            print(f"Skipping non-HTML content at {url} (Content-Type: {content_type})")
-            return ""
-
-        max_read_size = 5 * 1024 * 1024 # 5 MB limit
-        html_content_bytes = response.raw.read(max_read_size, decode_content=True)
-
-        if len(html_content_bytes) == max_read_size:
-            print(f"Warning: Content possibly truncated for {url} (reached {max_read_size} bytes)")
-
-        # Decoding logic
-        html_content = ""
-        detected_encoding = response.encoding if response.encoding else response.apparent_encoding
-        try:
-            if detected_encoding:
-                html_content = html_content_bytes.decode(detected_encoding, errors='replace')
-            else:
-                 # Fallback to utf-8 if detection fails
-                 html_content = html_content_bytes.decode('utf-8', errors='replace')
-                 print(f"Warning: No encoding detected for {url}, falling back to UTF-8.")
-        except Exception as decode_err:
-             print(f"Error decoding content from {url} with encoding {detected_encoding}: {decode_err}. Trying UTF-8.")
-             try: # Try UTF-8 as a last resort
-                 html_content = html_content_bytes.decode('utf-8', errors='replace')
-             except Exception as final_decode_err:
-                 print(f"FATAL: Could not decode content from {url} even with UTF-8: {final_decode_err}")
-                 return "" # Give up if decoding fails completely
-
-        soup = BeautifulSoup(html_content, 'html.parser')
-
-        for element in soup(["script", "style", "footer", "nav", "header", "aside", "form", "button", "input", "select", "textarea", "label", "iframe", "noscript", ".sidebar", ".ad", ".advertisement", ".popup", ".modal"]):
-            if hasattr(element, 'decompose'):
-                 element.decompose()
-
-        main_elements = soup.select('main, article, [role="main"], .main-content, #main-content, .post-content, .article-content, .entry-content')
-        if main_elements:
-            main_element = max(main_elements, key=lambda x: len(x.get_text(strip=True)))
-            text = main_element.get_text(separator='\n', strip=True)
-        else:
-            body = soup.find('body')
-            text = body.get_text(separator='\n', strip=True) if body else ""
-
-        lines = (line.strip() for line in text.splitlines())
-        chunks = (phrase.strip() for line in lines for phrase in line.split("  "))
-        text_content = '\n'.join(chunk for chunk in chunks if len(chunk) > 15) # Increased min length slightly
+        async with session.get(url, headers=headers) as response:
+            response.raise_for_status()
+
+            content_type = response.headers.get('content-type', '').lower()
+            if 'text/html' not in content_type and 'application/xhtml+xml' not in content_type:
+                print(f"Skipping non-HTML content at {url} (Content-Type: {content_type})")
+                return ""
+
+            max_read_size = 5 * 1024 * 1024 # 5 MB limit
+            # Headers are in but the body is not read yet, so oversized pages cost no transfer
+            if response.content_length and response.content_length > max_read_size:
+                print(f"Skipping oversized content at {url} (Content-Length: {response.content_length})")
+                return ""
+
+            # content.read(n) only returns what is already buffered, so keep reading until EOF or the cap
+            html_content_bytes = bytearray()
+            async for chunk in response.content.iter_chunked(64 * 1024):
+                html_content_bytes += chunk
+                if len(html_content_bytes) >= max_read_size:
+                    break
+            html_content_bytes = bytes(html_content_bytes[:max_read_size])
 
-        text_content = re.sub(r'\n{3,}', '\n\n', text_content)
-        text_content = re.sub(r'[ \t]+', ' ', text_content)
+            if len(html_content_bytes) == max_read_size:
+                print(f"Warning: Content possibly truncated for {url} (reached {max_read_size} bytes)")
 
-        max_content_length = 10000
-        if len(text_content) > max_content_length:
-            text_content = text_content[:max_content_length] + "...[Content truncated]"
+            detected_encoding = response.charset
 
+        loop = asyncio.get_running_loop()
+        text_content = await loop.run_in_executor(PARSE_POOL, parse_and_clean, html_content_bytes, detected_encoding, url)
+        if text_content:
+            URL_CACHE.set(url, text_content, expire=URL_CACHE_TTL)
         return text_content
 
-    except requests.exceptions.Timeout:
+    except asyncio.TimeoutError:
         print(f"Timeout error extracting content from {url}")
         return ""
-    except requests.exceptions.RequestException as e:
-        # Log specific HTTP errors if possible
-        status_code = e.response.status_code if e.response else 'N/A'
-        print(f"Request error extracting content from {url} (Status: {status_code}): {e}")
+    except aiohttp.ClientResponseError as e:
+        print(f"Request error extracting content from {url} (Status: {e.status}): {e}")
+        return ""
+    except aiohttp.ClientError as e:
+        print(f"Request error extracting content from {url} (Status: N/A): {e}")
         return ""
     except Exception as e:
         print(f"General error extracting content from {url}: {e}")
         return ""
 
-def process_content(urls, query):
+def get_embed_model():
+    """
+    Return the sentence embedding model, loading it on first use.
+    """
+    global embed_model
+    with embed_model_lock:
+        if embed_model is None:
+            # Imported here so torch only loads once retrieval is first used
+            from sentence_transformers import SentenceTransformer
+            print(f"Loading embedding model: {EMBED_MODEL_NAME}")
+            embed_model = SentenceTransformer(EMBED_MODEL_NAME)
+    return embed_model
+
+def split_passages(text):
+    """
+    Split page text into overlapping fixed-size character windows.
+    """
+    step = PASSAGE_SIZE - PASSAGE_OVERLAP
+    starts = list(range(0, max(len(text) - PASSAGE_OVERLAP, 1), step))
+    # A last window adding only a few new characters would be a near-duplicate
+    # of the previous one, so let the previous window run to the end instead
+    if len(starts) > 1 and len(text) - (starts[-1] + PASSAGE_OVERLAP) < PASSAGE_MIN_TAIL:
+        starts.pop()
+    return [text[i:i + PASSAGE_SIZE] for i in starts[:-1]] + [text[starts[-1]:]]
+
+def embed_page(url, content):
+    """
+    Return (passages, embeddings) for a page, reusing cached embeddings while its text is unchanged.
+    """
+    cache_key = ("embeddings", url, blake2b(content.encode(), digest_size=16).hexdigest())
+    cached = URL_CACHE.get(cache_key)
+    if cached is not None:
+        return cached
+
+    passages = split_passages(content)
+    embeddings = get_embed_model().encode(passages, batch_size=64, normalize_embeddings=True)
+    URL_CACHE.set(cache_key, (passages, embeddings), expire=URL_CACHE_TTL)
+    return passages, embeddings
+
+def rank_passages(pages, query):
+    """
+    Return the TOP_K_PASSAGES (url, passage) pairs most similar to the query.
+    Embeddings are normalized, so inner product equals cosine similarity.
+    """
+    import faiss
+
+    passage_urls = []
+    passages = []
+    page_embeddings = []
+    for url, content in pages:
+        page_passages, embeddings = embed_page(url, content)
+        passage_urls.extend([url] * len(page_passages))
+        passages.extend(page_passages)
+        page_embeddings.append(embeddings)
+
+    embeddings = np.vstack(page_embeddings).astype('float32')
+    index = faiss.IndexFlatIP(embeddings.shape[1])
+    index.add(embeddings)
+
+    query_embedding = get_embed_model().encode([query], normalize_embeddings=True).astype('float32')
+    _, ids = index.search(query_embedding, min(TOP_K_PASSAGES, len(passages)))
+    return [(passage_urls[i], passages[i]) for i in ids[0] if i >= 0]
+
+async def process_content(url_stream, query):
     """
     Process the content from multiple URLs and prepare it for the LLM.
+    Each URL from the search stream is dispatched for extraction as soon as it arrives.
     """
     all_content = []
     processed_count = 0
     processed_urls = [] # Keep track of URLs where content was successfully extracted
 
-    for url in urls:
-        print(f"Processing content from: {url}")
-        content = extract_content(url)
+    session = await get_http_session()
+    urls = []
+    tasks = []
+    seen_pages = set() # (host, path, query) keys already dispatched
+    async for url in url_stream:
+        parts = urlsplit(url)
+        # The query string often identifies the page (watch?v=..., article.php?id=...), so it is part of the key
+        page = (parts.netloc.lower(), parts.path.rstrip('/'), parts.query)
+        if page in seen_pages:
+            print(f"Skipping duplicate URL: {url}")
+            continue
+        seen_pages.add(page)
+        urls.append(url)
+        tasks.append(asyncio.create_task(extract_content(session, url)))
+
+    if not urls:
+        return urls, "", []
+
+    # gather() returns results in the original URL order
+    results = await asyncio.gather(*tasks)
+
+    pages = [] # (url, content) pairs that survived deduplication
+    accepted_hashes = [] # SimHashes of content already included
+    for url, content in zip(urls, results):
         if content:
-            # Store URL with content for later potential use by LLM
-            all_content.append(f"Source URL: {url}\n\n{content}\n\n---\n\n")
+            # Skip near-duplicate pages (e.g. syndicated articles) so they don't pad the LLM context
+            content_hash = Simhash(content).value
+            if any(bin(content_hash ^ h).count('1') <= SIMHASH_MAX_DISTANCE for h in accepted_hashes):
+                print(f"Skipping near-duplicate content from: {url}")
+                continue
+            accepted_hashes.append(content_hash)
+            pages.append((url, content))
             processed_urls.append(url) # Add to list of successfully processed URLs
             processed_count += 1
         else:
             print(f"No meaningful content extracted from: {url}")
 
-    if not all_content:
+    if not pages:
         print("No relevant content found from any source.")
-        return "No relevant content found from the search results.", [] # Return empty list for processed URLs
+        return urls, "No relevant content found from the search results.", [] # Return empty list for processed URLs
 
     print(f"Successfully processed content from {processed_count}/{len(urls)} URLs.")
+
+    # Only send the passages most relevant to the query instead of every page in full
+    try:
+        loop = asyncio.get_running_loop()
+        passages = await loop.run_in_executor(None, rank_passages, pages, query)
+        print(f"Selected {len(passages)} most relevant passages.")
+    except Exception as e:
+        print(f"Error ranking passages, using full page content: {e}")
+        passages = pages
+
+    for url, passage in passages:
+        # Store URL with content for later potential use by LLM
+        all_content.append(f"Source URL: {url}\n\n{passage}\n\n---\n\n")
+
     combined_content = "".join(all_content)
 
     max_combined_length = 28000 # Gemini 1.5 Flash has a large context, adjust if needed
@@ -209,45 +384,56 @@ def process_content(urls, query):
         print(f"Combined content length ({len(combined_content)}) exceeds limit ({max_combined_length}). Truncating.")
         combined_content = combined_content[:max_combined_length] + "...[Combined Content truncated due to length]"
 
-    # Return the combined content AND the list of URLs that actually yielded content
-    return combined_content, processed_urls
+    # Return the URLs found by search, the combined content AND the list of URLs that actually yielded content
+    return urls, combined_content, processed_urls
 
 
-# --- THIS IS THE MAIN CHANGE ---
-def generate_response(content, query, source_urls_with_content):
+def build_prompt(content, query):
     """
-    Generate a response using Gemini based on the content and query.
-    Instructs the LLM to list sources at the end.
+    Build the per-query message. Only the mutable part goes here; the instructions live in the static prompt prefix.
     """
-    if not conversation:
-        print("Error: ConversationChain is not initialized. Cannot generate response.")
-        return "Sorry, the AI assistant is not available right now."
-
-    try:
-        # Modified Prompt for end-of-response source listing
-        prompt = f"""
-        You are an AI assistant designed to answer user queries based *only* on the provided web search context.
-        Analyze the following web search results carefully. Each result starts with "Source URL: [url]".
-        Synthesize the information to provide a comprehensive, accurate, and neutral response to the user's query.
-        Focus on information directly present in the provided text snippets.
-        Do not add information not found in the context. Do not make assumptions or inferences beyond the text.
-        If the provided context does not contain sufficient information to answer the query thoroughly, clearly state that the information is limited or not available in the search results.
-        Structure the response clearly. Use bullet points or numbered lists if appropriate for readability.
-        **Do NOT include inline source citations like [Source: url] within the main body of your answer.**
-
-        USER QUERY: "{query}"
-
+    return f"""
         PROVIDED WEB SEARCH CONTEXT:
         --- START CONTEXT ---
         {content}
         --- END CONTEXT ---
 
-        Based *only* on the context above, answer the user query.
+        USER QUERY: "{query}"
         """
 
+def get_history():
+    """
+    Return a snapshot of the conversation history for a new chat.
+    """
+    with chat_history_lock:
+        return list(chat_history)
+
+def record_turn(query, response):
+    """
+    Append a finished query/answer pair to the history, keeping only the last MAX_HISTORY_TURNS turns.
+    """
+    with chat_history_lock:
+        chat_history.append({"role": "user", "parts": [query]})
+        chat_history.append({"role": "model", "parts": [response]})
+        del chat_history[:-2 * MAX_HISTORY_TURNS]
+
+
+# --- THIS IS THE MAIN CHANGE ---
+def generate_response(content, query, source_urls_with_content):
+    """
+    Generate a response using Gemini based on the content and query.
+    Instructs the LLM to list sources at the end.
+    """
+    if not llm:
+        print("Error: Gemini LLM is not initialized. Cannot generate response.")
+        return LLM_UNAVAILABLE_MESSAGE
+
+    try:
         print(f"Generating response for query: {query} (Sources to be listed at end)")
-        response = conversation.predict(input=prompt)
+        chat = llm.start_chat(history=get_history())
+        response = chat.send_message(build_prompt(content, query)).text
         print("LLM Response Generated.")
+        record_turn(query, response)
 
         # --- Optional: Post-processing to ensure sources are present ---
         # This is a fallback in case the LLM forgets the source list.
@@ -263,51 +449,159 @@ def generate_response(content, query, source_urls_with_content):
         print(f"Error generating response with LLM: {e}")
         # import traceback # Uncomment for debugging
         # traceback.print_exc() # Uncomment for debugging
-        return "Sorry, I encountered an error while processing your request with the AI model. Please try again."
+        return LLM_ERROR_MESSAGE
 # --- END OF MAIN CHANGE ---
 
+def generate_response_stream(content, query):
+    """
+    Generate a response like generate_response, yielding text chunks as Gemini produces them.
+    Errors are raised to the caller, and the turn is only recorded once the stream has been fully consumed.
+    """
+    print(f"Streaming response for query: {query}")
+    chat = llm.start_chat(history=get_history())
+    chunks = []
+    for chunk in chat.send_message(build_prompt(content, query), stream=True):
+        chunks.append(chunk.text)
+        yield chunk.text
+    print("LLM Response Streamed.")
+    record_turn(query, "".join(chunks))
+
+def retrieve_context(query):
+    """
+    Steps 1 & 2: search for URLs and extract their content, pipelined so each page is fetched while the search response is still being read.
+    Returns (initial_urls, content, urls_with_content, fallback), where fallback is a ready
+    response payload when nothing usable was found, otherwise None.
+    """
+    initial_urls, content, urls_with_content = run_async(process_content(search_and_retrieve(query), query))
+
+    if not initial_urls:
+        print("Search returned no URLs.")
+        return initial_urls, content, urls_with_content, {
+            "response": "I couldn't find relevant web pages for your query using the search service. Please try rephrasing your query.",
+            "sources": [] # Return empty list
+        }
+
+    if not content or not urls_with_content: # Check if content extraction yielded anything
+         print("No content could be extracted from the found URLs.")
+         return initial_urls, content, urls_with_content, {
+             "response": "I found some web pages, but I couldn't extract useful information from them to answer your query.",
+             "sources": initial_urls # Provide the originally found URLs
+         }
+
+    return initial_urls, content, urls_with_content, None
+
+def sse_event(payload):
+    """
+    Format a payload as a Server-Sent Events message.
+    """
+    return f"data: {orjson.dumps(payload).decode()}\n\n"
+
+
+def ojsonify(obj, status=200):
+    """
+    Build a JSON response with orjson, which serializes much faster than Flask's default encoder.
+    """
+    return app.response_class(orjson.dumps(obj), status=status, mimetype='application/json')
+
 
 @app.route('/api/query', methods=['POST'])
 def handle_query():
-    if not llm or not conversation:
-         return jsonify({"error": "AI service is not properly configured or initialized."}), 503
+    if not llm:
+         return ojsonify({"error": "AI service is not properly configured or initialized."}, 503)
 
     data = request.json
     if not data or 'query' not in data:
-        return jsonify({"error": "No query provided"}), 400
+        return ojsonify({"error": "No query provided"}, 400)
+    if not isinstance(data['query'], str):
+        return ojsonify({"error": "Query must be a string"}, 400)
 
     query = data['query']
     print(f"\n--- New Query Received: {query} ---")
 
-    # Step 1: Search for URLs
-    initial_urls = search_and_retrieve(query)
-
-    if not initial_urls:
-        print("Search returned no URLs.")
-        return jsonify({
-            "response": "I couldn't find relevant web pages for your query using the search service. Please try rephrasing your query.",
-            "sources": [] # Return empty list
-        })
+    cache_key = query_cache_key(query)
+    with response_cache_lock:
+        cached = RESPONSE_CACHE.get(cache_key)
+    if cached is not None:
+        print("Returning cached response.")
+        return ojsonify(cached)
 
-    # Step 2: Extract content and get the list of URLs that actually had content
-    content, urls_with_content = process_content(initial_urls, query) # Now returns URLs with content
-
-    if not content or not urls_with_content: # Check if content extraction yielded anything
-         print("No content could be extracted from the found URLs.")
-         return jsonify({
-             "response": "I found some web pages, but I couldn't extract useful information from them to answer your query.",
-             "sources": initial_urls # Provide the originally found URLs
-         })
+    # Steps 1 & 2: Search for URLs and extract content
+    initial_urls, content, urls_with_content, fallback = retrieve_context(query)
+    if fallback:
+        return ojsonify(fallback)
 
     # Step 3: Generate response using content AND the list of successful URLs (for fallback)
     response = generate_response(content, query, urls_with_content)
 
     # Step 4: Return response and the *initial* list of URLs found by search
-    print(f"Final response generated. Sending to client.")
-    return jsonify({
+    result = {
         "response": response, # This string now contains the answer AND the sources list at the end
         "sources": initial_urls # This list contains all URLs initially found by SerpApi
-    })
+    }
+    if response not in (LLM_UNAVAILABLE_MESSAGE, LLM_ERROR_MESSAGE):
+        with response_cache_lock:
+            RESPONSE_CACHE[cache_key] = result
+
+    print(f"Final response generated. Sending to client.")
+    return ojsonify(result)
+
+
+@app.route('/api/query_stream', methods=['POST'])
+def handle_query_stream():
+    """
+    Same pipeline as /api/query, but streams the answer as Server-Sent Events.
+    Emits {"sources": [...]} first, then {"token": "..."} chunks, then {"done": true}.
+    If the LLM fails, an {"error": "..."} event is sent instead of further tokens; it is separate from
+    any partial answer already streamed, and clients should show it apart and not cache the answer.
+    """
+    if not llm:
+         return ojsonify({"error": "AI service is not properly configured or initialized."}, 503)
+
+    data = request.json
+    if not data or 'query' not in data:
+        return ojsonify({"error": "No query provided"}, 400)
+    if not isinstance(data['query'], str):
+        return ojsonify({"error": "Query must be a string"}, 400)
+
+    query = data['query']
+    print(f"\n--- New Streaming Query Received: {query} ---")
+
+    def generate():
+        cache_key = query_cache_key(query)
+        with response_cache_lock:
+            cached = RESPONSE_CACHE.get(cache_key)
+        if cached is not None:
+            print("Returning cached response.")
+            yield sse_event({"sources": cached["sources"]})
+            yield sse_event({"token": cached["response"]})
+            yield sse_event({"done": True})
+            return
+
+        initial_urls, content, urls_with_content, fallback = retrieve_context(query)
+        if fallback:
+            yield sse_event({"sources": fallback["sources"]})
+            yield sse_event({"token": fallback["response"]})
+            yield sse_event({"done": True})
+            return
+
+        yield sse_event({"sources": initial_urls})
+        chunks = []
+        try:
+            for chunk in generate_response_stream(content, query):
+                chunks.append(chunk)
+                yield sse_event({"token": chunk})
+        except Exception as e:
+            print(f"Error generating response with LLM: {e}")
+            yield sse_event({"error": LLM_ERROR_MESSAGE})
+            yield sse_event({"done": True})
+            return
+
+        with response_cache_lock:
+            RESPONSE_CACHE[cache_key] = {"response": "".join(chunks), "sources": initial_urls}
+        print(f"Final response streamed to client.")
+        yield sse_event({"done": True})
+
+    return Response(generate(), mimetype='text/event-stream', headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
 
 
 @app.route('/api/health', methods=['GET'])
@@ -315,21 +609,19 @@ def health_check():
     status = {
         "status": "ok",
         "llm_initialized": llm is not None,
-        "conversation_initialized": conversation is not None,
         "serpapi_key_present": SERPAPI_API_KEY is not None,
         "google_api_key_present": GOOGLE_API_KEY is not None
     }
-    http_status = 200 if llm and conversation and SERPAPI_API_KEY and GOOGLE_API_KEY else 503
-    return jsonify(status), http_status
+    http_status = 200 if llm and SERPAPI_API_KEY and GOOGLE_API_KEY else 503
+    return ojsonify(status, http_status)
 
 
 if __name__ == '__main__':
-    if not GOOGLE_API_KEY or not SERPAPI_API_KEY or not llm or not conversation:
+    if not GOOGLE_API_KEY or not SERPAPI_API_KEY or not llm:
         print("\nFATAL ERROR: One or more API keys are missing or components failed to initialize.")
         print(f"  - Google API Key Present: {bool(GOOGLE_API_KEY)}")
         print(f"  - SerpApi Key Present: {bool(SERPAPI_API_KEY)}")
         print(f"  - LLM Initialized: {bool(llm)}")
-        print(f"  - Conversation Initialized: {bool(conversation)}")
         print("Exiting due to configuration errors.\n")
         # exit(1) # Optional: Force exit if you prefer
     else:
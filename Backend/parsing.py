@@ -0,0 +1,70 @@
+# HTML decoding and text extraction. Kept free of import-time side effects because
+# app.py runs these functions in separate worker processes, which import this module.
+from selectolax.lexbor import LexborHTMLParser
+from charset_normalizer import from_bytes
+
+# Selectors used on every extracted page
+_REMOVE_SELECTOR = 'script, style, footer, nav, header, aside, form, button, input, select, textarea, label, iframe, noscript, .sidebar, .ad, .advertisement, .popup, .modal'
+_MAIN_SELECTOR = 'main, article, [role="main"], .main-content, #main-content, .post-content, .article-content, .entry-content'
+
+def decode_html(html_content_bytes, declared_encoding, url):
+    """
+    Decode a page body using the charset from the Content-Type header.
+    Only when none is declared, detect it from the first 64 KB of the body.
+    """
+    encoding = declared_encoding
+    if not encoding:
+        best_match = from_bytes(html_content_bytes[:65536]).best()
+        encoding = best_match.encoding if best_match else 'utf-8'
+    try:
+        return html_content_bytes.decode(encoding, errors='replace')
+    except LookupError:
+        print(f"Unknown encoding {encoding} for {url}, falling back to UTF-8.")
+        return html_content_bytes.decode('utf-8', errors='replace')
+
+def clean_text(text):
+    """
+    Split extracted text into phrases, collapse runs of spaces/tabs and drop
+    short fragments, in a single pass over the lines.
+    """
+    kept = []
+    for line in text.splitlines():
+        for phrase in line.split("  "):
+            phrase = phrase.strip()
+            if len(phrase) > 15: # Increased min length slightly
+                kept.append(' '.join(phrase.split()))
+    return '\n'.join(kept)
+
+def parse_html(html_content):
+    """
+    Parse decoded HTML and return the cleaned main text.
+    """
+    tree = LexborHTMLParser(html_content)
+
+    # One fused tree walk for all boilerplate. Matches come back in document order, so going in
+    # reverse removes nested matches before their ancestors and never touches a freed node.
+    for node in reversed(tree.css(_REMOVE_SELECTOR)):
+        node.decompose()
+
+    main_elements = tree.css(_MAIN_SELECTOR)
+    if main_elements:
+        main_element = max(main_elements, key=lambda x: len(x.text(strip=True)))
+        text = main_element.text(separator='\n', strip=True)
+    else:
+        body = tree.body
+        text = body.text(separator='\n', strip=True) if body else ""
+
+    text_content = clean_text(text)
+
+    max_content_length = 10000
+    if len(text_content) > max_content_length:
+        text_content = text_content[:max_content_length] + "...[Content truncated]"
+
+    return text_content
+
+def parse_and_clean(html_content_bytes, declared_encoding, url):
+    """
+    Decode and parse a raw page body into cleaned text.
+    Runs in the backend's parse worker processes, so it must stay a module-level function.
+    """
+    return parse_html(decode_html(html_content_bytes, declared_encoding, url))
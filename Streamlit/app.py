@@ -1,6 +1,10 @@
 import streamlit as st
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import json
+import threading
+from cachetools import TTLCache
 import os
 from dotenv import load_dotenv
 
@@ -61,23 +65,49 @@ if "messages" not in st.session_state:
 st.title("DeepFetch AI")
 st.markdown("Ask any question and get an AI response based on real-time web search results.")
 
-# Function to send query to backend API
-def send_query(query):
-    try:
-        response = requests.post(
-            f"{API_URL}/api/query",
-            json={"query": query},
-            headers={"Content-Type": "application/json"}
-        )
-        
-        if response.status_code == 200:
-            return response.json()
-        else:
-            st.error(f"Error: Received status code {response.status_code}")
-            return {"response": "Sorry, there was an error processing your request.", "sources": []}
-    except Exception as e:
-        st.error(f"Error communicating with the API: {e}")
-        return {"response": "Sorry, there was an error connecting to the backend service.", "sources": []}
+# Shared HTTP session so backend calls reuse pooled keep-alive connections across reruns
+@st.cache_resource
+def get_session():
+    session = requests.Session()
+    adapter = HTTPAdapter(
+        pool_connections=32,
+        pool_maxsize=32,
+        max_retries=Retry(total=2, backoff_factor=0.3, status_forcelist=[502, 503, 504])
+    )
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+# Completed answers keyed by query, shared across sessions for an hour, so asking the same
+# question again is rendered locally without a backend round trip
+@st.cache_resource
+def get_answer_cache():
+    return TTLCache(maxsize=128, ttl=3600), threading.Lock()
+
+# Function to stream a query's answer from the backend API
+# The backend sends Server-Sent Events: the sources first, then answer tokens as they are generated
+def stream_query(query, response_data):
+    with get_session().post(
+        f"{API_URL}/api/query_stream",
+        json={"query": query},
+        headers={"Content-Type": "application/json"},
+        stream=True
+    ) as response:
+        response.raise_for_status()
+        response.encoding = "utf-8"
+        for line in response.iter_lines(decode_unicode=True):
+            if not line or not line.startswith("data: "):
+                continue
+            event = json.loads(line[len("data: "):])
+            if "sources" in event:
+                response_data["sources"] = event["sources"]
+            elif "token" in event:
+                yield event["token"]
+            elif "error" in event:
+                # Kept out of the token stream so it is not spliced onto a partial answer
+                response_data["error"] = event["error"]
+            elif event.get("done"):
+                response_data["complete"] = True
 
 # Display chat history
 for message in st.session_state.messages:
@@ -105,13 +135,37 @@ if user_query:
     
     # Display a spinner while waiting for the response
     with st.spinner("Searching the web and generating a response..."):
-        # Send query to backend
-        response_data = send_query(user_query)
-        
-        # Display assistant response
+        answer_cache, answer_cache_lock = get_answer_cache()
+        with answer_cache_lock:
+            cached_answer = answer_cache.get(user_query)
+
+        # Display assistant response, from the cache or as it streams in from the backend
         with st.chat_message("assistant"):
-            st.markdown(response_data["response"])
-            if "sources" in response_data and response_data["sources"]:
+            if cached_answer is not None:
+                response_data = dict(cached_answer)
+                st.markdown(response_data["response"])
+            else:
+                response_data = {"response": "", "sources": []}
+                try:
+                    response_data["response"] = st.write_stream(stream_query(user_query, response_data))
+                    if response_data.get("error"):
+                        st.error(response_data["error"])
+                        # Kept in the chat history below any partial answer, separated by a rule
+                        partial_answer = response_data["response"] or ""
+                        response_data["response"] = f"{partial_answer}\n\n---\n\n{response_data['error']}" if partial_answer else response_data["error"]
+                    # Only memoize answers that streamed to the end without an error
+                    if response_data.get("complete") and not response_data.get("error"):
+                        with answer_cache_lock:
+                            answer_cache[user_query] = {"response": response_data["response"], "sources": response_data["sources"]}
+                except requests.exceptions.HTTPError as e:
+                    st.error(f"Error: Received status code {e.response.status_code}")
+                    response_data["response"] = "Sorry, there was an error processing your request."
+                    st.markdown(response_data["response"])
+                except Exception as e:
+                    st.error(f"Error communicating with the API: {e}")
+                    response_data["response"] = "Sorry, there was an error connecting to the backend service."
+                    st.markdown(response_data["response"])
+            if response_data["sources"]:
                 st.markdown("#### Sources:")
                 for idx, source in enumerate(response_data["sources"]):
                     st.markdown(f"{idx+1}. [{source}]({source})")